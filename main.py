@@ -1,11 +1,23 @@
 import sys 
-from source import configuration, JellyfinAPI, TmdbAPI, email_template, email_controller
+from source import configuration, JellyfinAPI, email_template, email_controller, tmdb_cache
 import datetime as dt
 from source.configuration import logging
 from source.configuration_checker import check_configuration
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 import source.utils as utils
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of TMDB requests sent concurrently. The request rate itself is limited in TmdbAPI
+TMDB_MAX_WORKERS = 8
+
+# Poster used when TMDB doesn't provide one
+DEFAULT_POSTER = "https://redthread.uoregon.edu/files/original/affd16fd5264cab9197da4cd1a996f820e601ee4.png"
+
+# Keys an item must have to be included in the newsletter
+EPISODE_REQUIRED_KEYS = frozenset({"SeriesId", "SeriesName", "SeasonName"})
+SERIES_REQUIRED_KEYS = frozenset({"Name", "Id"})
+MOVIE_REQUIRED_KEYS = frozenset({"Name", "Id", "DateCreated"})
 
 
 def populate_series_item_from_episode(series_items, item):
@@ -27,31 +39,71 @@ def populate_series_item_from_episode(series_items, item):
     """
 
 
-    required_keys = ["SeriesId", "SeriesName", "SeasonName"]
-    for key in required_keys:
-        if key not in item.keys():
-            logging.warning(f"Item {item} has no {key}. Skipping.")
-            return
-    if item["SeriesId"] not in series_items.keys():
-        series_items[item["SeriesId"]] = {
+    missing_keys = EPISODE_REQUIRED_KEYS - item.keys()
+    if missing_keys:
+        logging.warning(f"Item {item} has no {', '.join(sorted(missing_keys))}. Skipping.")
+        return
+    series_item = series_items.get(item["SeriesId"])
+    if series_item is None:
+        series_item = series_items[item["SeriesId"]] = {
             "series_name": item["SeriesName"],  # Name of the series, provided by Jellyfin
             "episodes": [],
             "seasons": [],
             "created_on": "undefined",
             "description": "No description available.",  # will be populated later, when parsing the series item
             "year": "undefined",# will be populated later, when parsing the series item
-            "poster": "https://redthread.uoregon.edu/files/original/affd16fd5264cab9197da4cd1a996f820e601ee4.png"# will be populated later, when parsing the series item
+            "poster": DEFAULT_POSTER# will be populated later, when parsing the series item
         }
-    if item["SeasonName"] not in series_items[item["SeriesId"]]["seasons"]:
-        series_items[item["SeriesId"]]["seasons"].append(item["SeasonName"])
-    series_items[item["SeriesId"]]["episodes"].append(item.get('IndexNumber'))
-    if series_items[item["SeriesId"]]["created_on"] != "undefined" or series_items[item["SeriesId"]]["created_on"] is not None:
-        try: 
-            if dt.datetime.fromisoformat(series_items[item["SeriesId"]]["created_on"]) < dt.datetime.fromisoformat(item["DateCreated"]):
-                series_items[item["SeriesId"]]["created_on"] = item["DateCreated"]
-        except:
-            pass
-    series_items[item["SeriesId"]]["created_on"] = item.get("DateCreated", "undefined") 
+    if item["SeasonName"] not in series_item["seasons"]:
+        series_item["seasons"].append(item["SeasonName"])
+    series_item["episodes"].append(item.get('IndexNumber'))
+    # Keep the most recent creation date. Jellyfin dates are ISO-8601 UTC strings, they sort lexically without parsing.
+    episode_created_on = item.get("DateCreated")
+    if episode_created_on and (series_item["created_on"] == "undefined" or episode_created_on > series_item["created_on"]):
+        series_item["created_on"] = episode_created_on
+
+
+def get_series_tmdb_info(item):
+    """
+    Retrieve the TMDB information of a series, by id if Jellyfin provides it, by title otherwise.
+    Returns None if the series has not been found on TMDB.
+    """
+    tmdb_info = None
+    tmdb_id = None
+    if "ProviderIds" in item.keys():
+        if "Tmdb" in item["ProviderIds"].keys():
+            tmdb_id = item["ProviderIds"]["Tmdb"]
+
+    if tmdb_id is not None: # id provided by Jellyfin
+        try:
+            tmdb_info = tmdb_cache.cached_detail_by_id(id=tmdb_id, type="tv")
+        except Exception as e:
+            logging.error(f"Item {item['Name']} could not be retrieved from TMDB by id due to an API error: {e}")     
+            logging.info(f"Retrying search for item {item} by title.")
+
+    if tmdb_id is None or tmdb_info is None:
+        logging.info(f"Item {item} has no TMDB id or search by id failed. Searching by title.")
+        try:
+            tmdb_info = tmdb_cache.cached_detail_by_title(title=item["Name"], type="tv", year=item["ProductionYear"])
+        except Exception as e:
+            logging.error(f"Item {item['Name']} could not be retrieved from TMDB by title due to an API error: {e}")   
+    return tmdb_info
+
+
+def get_movie_tmdb_info(item):
+    """
+    Retrieve the TMDB information of a movie, by id if Jellyfin provides it, by title otherwise.
+    Returns None if the movie has not been found on TMDB.
+    """
+    tmdb_id = None
+    if "ProviderIds" in item.keys():
+        if "Tmdb" in item["ProviderIds"].keys():
+            tmdb_id = item["ProviderIds"]["Tmdb"]
+
+    if tmdb_id is not None: # id provided by Jellyfin
+        return tmdb_cache.cached_detail_by_id(id=tmdb_id, type="movie")
+    logging.info(f"Item {item['Name']} has no TMDB id, searching by title.")
+    return tmdb_cache.cached_detail_by_title(title=item["Name"], type="movie", year=item["ProductionYear"])
 
 
 def populate_series_item_with_series_related_information(series_items, watched_tv_folders_id):
@@ -59,110 +111,124 @@ def populate_series_item_with_series_related_information(series_items, watched_t
     populate_series_item_from_episode will populate the series item with the episode information, but it will not include the series information (description, year, poster).
     This function will populate the series item with the series information.
     """
+    # Each series lives in one folder only, so fetch the series in bulk, folder by folder, and only look for the ones not found yet
+    jellyfin_series = {}
     for folder_id in watched_tv_folders_id:
-        for series_id in series_items.keys():
-            item = JellyfinAPI.get_item_from_parent_by_id(parent_id=folder_id, item_id=series_id)
-            if item is not None:
-                if "Type" not in item.keys() or item["Type"] != "Series":
-                    logging.warning(f"Item {item} is not a series. Skipping.")
-                    continue
-                required_keys = ["Name", "Id"]
-                for key in required_keys:
-                    if key not in item.keys():
-                        logging.warning(f"Item {item} has no {key}. Skipping.")
-                        continue
-                series_items[item['Id']]["year"] = item["ProductionYear"]
-                tmdb_id = None
-                if "ProviderIds" in item.keys():
-                    if "Tmdb" in item["ProviderIds"].keys():
-                        tmdb_id = item["ProviderIds"]["Tmdb"]
-    
-                if tmdb_id is not None: # id provided by Jellyfin
-                    try:
-                        tmdb_info = TmdbAPI.get_media_detail_from_id(id=tmdb_id, type="tv")
-                    except Exception as e:
-                        logging.error(f"Item {item['Name']} could not be retrieved from TMDB by id due to an API error: {e}")     
-                        logging.info(f"Retrying search for item {item} by title.")
-
-                if tmdb_id is None or tmdb_info is None:
-                    logging.info(f"Item {item} has no TMDB id or search by id failed. Searching by title.")
-                    try:
-                        tmdb_info = TmdbAPI.get_media_detail_from_title(title=item["Name"], type="tv", year=item["ProductionYear"])
-                    except Exception as e:
-                        logging.error(f"Item {item['Name']} could not be retrieved from TMDB by title due to an API error: {e}")   
-                                       
-                if tmdb_info is None:
-                    logging.warning(f"Item {item['Name']} has not been found on TMDB. Skipping.")
-                else:
-                    if "overview" not in tmdb_info.keys():
-                        logging.warning(f"Item {item['Name']} has no overview.")
-                        tmdb_info["Overview"] = "No overview available."
-                    series_items[item['Id']]["description"] = tmdb_info["overview"]
-                    
-                    series_items[item['Id']]["poster"] = f"https://image.tmdb.org/t/p/w500{tmdb_info['poster_path']}" if tmdb_info["poster_path"] else "https://redthread.uoregon.edu/files/original/affd16fd5264cab9197da4cd1a996f820e601ee4.png"
+        missing_series_ids = [series_id for series_id in series_items.keys() if series_id not in jellyfin_series]
+        if not missing_series_ids:
+            break
+        jellyfin_series.update(JellyfinAPI.get_items_from_parent_by_ids(parent_id=folder_id, item_ids=missing_series_ids))
+
+    series_to_lookup = []
+    for series_id in series_items.keys():
+        item = jellyfin_series.get(series_id)
+        if item is not None:
+            if "Type" not in item.keys() or item["Type"] != "Series":
+                logging.warning(f"Item {item} is not a series. Skipping.")
+                continue
+            missing_keys = SERIES_REQUIRED_KEYS - item.keys()
+            if missing_keys:
+                logging.warning(f"Item {item} has no {', '.join(sorted(missing_keys))}. Skipping.")
+                continue
+            series_items[item['Id']]["year"] = item["ProductionYear"]
+            series_to_lookup.append(item)
+        else:
+            logging.warning(f"Item {series_id} has not been found in Jellyfin. Skipping.")
+
+    # TMDB lookups are I/O bound, they are run concurrently. series_items is only updated from this thread.
+    with ThreadPoolExecutor(max_workers=TMDB_MAX_WORKERS) as executor:
+        for item, tmdb_info in zip(series_to_lookup, executor.map(get_series_tmdb_info, series_to_lookup)):
+            if tmdb_info is None:
+                logging.warning(f"Item {item['Name']} has not been found on TMDB. Skipping.")
             else:
-                logging.warning(f"Item {series_id} has not been found in Jellyfin. Skipping.")
+                if "overview" not in tmdb_info.keys():
+                    logging.warning(f"Item {item['Name']} has no overview.")
+                    tmdb_info["Overview"] = "No overview available."
+                series_items[item['Id']]["description"] = tmdb_info["overview"]
+                
+                series_items[item['Id']]["poster"] = f"https://image.tmdb.org/t/p/w500{tmdb_info['poster_path']}" if tmdb_info["poster_path"] else DEFAULT_POSTER
 
     
 
 
+def get_watched_folders_id(folders_by_name, watched_folders, media_kind, excluded_names=frozenset()):
+    """
+    Return the ids of the Jellyfin root folders matching the configured watched folders, in the configuration order.
+    folders_by_name maps a case-folded folder name to the Jellyfin folders with this name.
+    """
+    folders_id = []
+    for folder_name in dict.fromkeys(str(folder).casefold() for folder in watched_folders or []):
+        if folder_name == "" or folder_name in excluded_names:
+            continue
+        if folder_name not in folders_by_name:
+            logging.warning(f"Watched folder {folder_name} has not been found in Jellyfin. Skipping.")
+            continue
+        for item in folders_by_name[folder_name]:
+            folders_id.append(item["Id"])
+            logging.info(f"Folder {item['Name']} is watched for {media_kind}.")
+    return folders_id
+
+
 def send_newsletter():
     logging.info("Sending newsletter ...")
+    # TMDB lookups are only memoized within a run, the next scheduled runs must not reuse them
+    tmdb_cache.clear()
+    # Same reference time for movies, TV series and the saved last newsletter date
+    now = dt.datetime.now()
+    observed_since = now - dt.timedelta(days=configuration.conf.jellyfin.observed_period_days)
     folders = JellyfinAPI.get_root_items()
-    watched_film_folders_id = []
-    watched_tv_folders_id = []
+    folders_by_name = {}
     for item in folders:
         if "Name" not in item:
             logging.warning(f"Item {item} has no Name. Skipping.")
             continue
-        if item["Name"] in configuration.conf.jellyfin.watched_film_folders :
-           watched_film_folders_id.append(item["Id"])
-           logging.info(f"Folder {item['Name']} is watched for films.")
-        elif item["Name"] in configuration.conf.jellyfin.watched_tv_folders :
-            watched_tv_folders_id.append(item["Id"])
-            logging.info(f"Folder {item['Name']} is watched for TV series.")
-        else:
-            logging.warning(f"Folder {item['Name']} is not watched. Skipping. Add \"{item['Name']}\" in your watched folder to include it.")
+        folders_by_name.setdefault(item["Name"].casefold(), []).append(item)
+
+    watched_film_folders_id = get_watched_folders_id(folders_by_name, configuration.conf.jellyfin.watched_film_folders, "films")
+    # A folder listed in both watched lists is only watched for films
+    watched_tv_folders_id = get_watched_folders_id(folders_by_name, configuration.conf.jellyfin.watched_tv_folders, "TV series", excluded_names=configuration.conf.jellyfin.watched_film_folders_set)
+    for folder_name, folders_with_name in folders_by_name.items():
+        if folder_name not in configuration.conf.jellyfin.watched_film_folders_set and folder_name not in configuration.conf.jellyfin.watched_tv_folders_set:
+            for item in folders_with_name:
+                logging.warning(f"Folder {item['Name']} is not watched. Skipping. Add \"{item['Name']}\" in your watched folder to include it.")
 
     total_movie = 0
     total_tv = 0
     movie_items = {}
     series_items = {}
-
-
+    # Read once, the last newsletter date doesn't change during the run
+    last_newsletter_date = utils.get_last_newsletter_date() if configuration.conf.jellyfin.ignore_item_added_before_last_newsletter else None
+    last_newsletter_cutoff = None
+    if last_newsletter_date is not None:
+        # An item is ignored if its creation day, at midnight, is before the last newsletter, i.e. if its day is strictly before this cutoff.
+        # ISO-8601 dates sort lexically, so items are compared on their "YYYY-MM-DD" prefix without parsing them.
+        cutoff_day = last_newsletter_date.date()
+        if last_newsletter_date.time() != dt.time():
+            cutoff_day += dt.timedelta(days=1)
+        last_newsletter_cutoff = cutoff_day.isoformat()
+
+
+    movies_to_lookup = []
     for folder_id in watched_film_folders_id:
-        items, total_count = JellyfinAPI.get_item_from_parent(parent_id=folder_id,type="movie", minimum_creation_date=dt.datetime.now() - dt.timedelta(days=configuration.conf.jellyfin.observed_period_days))
+        items, total_count = JellyfinAPI.get_item_from_parent(parent_id=folder_id,type="movie", minimum_creation_date=observed_since)
         total_movie += total_count
         for item in items:
-            required_keys = ["Name", "Id", "DateCreated"]
-            for key in required_keys:
-                if key not in item.keys():
-                    logging.warning(f"Item {item} has no {key}. Skipping.")
+            missing_keys = MOVIE_REQUIRED_KEYS - item.keys()
+            if missing_keys:
+                logging.warning(f"Item {item} has no {', '.join(sorted(missing_keys))}. Skipping.")
+                continue
+            if last_newsletter_cutoff is not None:
+                if item["DateCreated"] is not None and item["DateCreated"][:10] < last_newsletter_cutoff:
+                    logging.info(f"ignore_item_added_before_last_newsletter is set to True and Item {item['Name']} was added before the last newsletter. Ignoring.")
                     continue
-            if configuration.conf.jellyfin.ignore_item_added_before_last_newsletter:
-                last_newsletter_date = utils.get_last_newsletter_date()
-                if last_newsletter_date is not None:
-                    if item["DateCreated"] is not None and dt.datetime.strptime(item["DateCreated"].split("T")[0], "%Y-%m-%d") < last_newsletter_date:
-                        logging.info(f"ignore_item_added_before_last_newsletter is set to True and Item {item['Name']} was added before the last newsletter. Ignoring.")
-                        continue
-            tmdb_id = None
             if "ProductionYear"  not in item.keys():
                 logging.warning(f"Item {item['Name']} has no production year.")
                 item["ProductionYear"] = 0
-            if "DateCreated" not in item.keys():
-                logging.warning(f"Item {item['Name']} has no creation date.")
-                item["DateCreated"] = None
-            if "ProviderIds" in item.keys():
-                if "Tmdb" in item["ProviderIds"].keys():
-                    tmdb_id = item["ProviderIds"]["Tmdb"]
-            
-            
-            if tmdb_id is not None: # id provided by Jellyfin
-                tmdb_info = TmdbAPI.get_media_detail_from_id(id=tmdb_id, type="movie")
-            else:
-                logging.info(f"Item {item['Name']} has no TMDB id, searching by title.")
-                tmdb_info = TmdbAPI.get_media_detail_from_title(title=item["Name"], type="movie", year=item["ProductionYear"])
+            movies_to_lookup.append(item)
 
+    # TMDB lookups are I/O bound, they are run concurrently. movie_items is only updated from this thread.
+    with ThreadPoolExecutor(max_workers=TMDB_MAX_WORKERS) as executor:
+        for item, tmdb_info in zip(movies_to_lookup, executor.map(get_movie_tmdb_info, movies_to_lookup)):
             if tmdb_info is None:
                 logging.warning(f"Item {item['Name']} has not been found on TMDB. Skipping.")
             else:
@@ -175,20 +241,18 @@ def send_newsletter():
                     "year":item["ProductionYear"],
                     "created_on":item["DateCreated"],
                     "description": tmdb_info["overview"],
-                    "poster": f"https://image.tmdb.org/t/p/w500{tmdb_info['poster_path']}" if tmdb_info["poster_path"] else "https://redthread.uoregon.edu/files/original/affd16fd5264cab9197da4cd1a996f820e601ee4.png"
+                    "poster": f"https://image.tmdb.org/t/p/w500{tmdb_info['poster_path']}" if tmdb_info["poster_path"] else DEFAULT_POSTER
                 }
             
     
     for folder_id in watched_tv_folders_id:
-        items, total_count = JellyfinAPI.get_item_from_parent(parent_id=folder_id, type="tv", minimum_creation_date=dt.datetime.now() - dt.timedelta(days=configuration.conf.jellyfin.observed_period_days))
+        items, total_count = JellyfinAPI.get_item_from_parent(parent_id=folder_id, type="tv", minimum_creation_date=observed_since)
         total_tv += total_count
         for item in items:
-            if configuration.conf.jellyfin.ignore_item_added_before_last_newsletter:
-                last_newsletter_date = utils.get_last_newsletter_date()
-                if last_newsletter_date is not None:
-                    if item["DateCreated"] is not None and dt.datetime.strptime(item["DateCreated"].split("T")[0], "%Y-%m-%d") < last_newsletter_date:
-                        logging.info(f"ignore_item_added_before_last_newsletter is set to True and Item {item.get('Name')} was added before the last newsletter. Ignoring.")
-                        continue
+            if last_newsletter_cutoff is not None:
+                if item["DateCreated"] is not None and item["DateCreated"][:10] < last_newsletter_cutoff:
+                    logging.info(f"ignore_item_added_before_last_newsletter is set to True and Item {item.get('Name')} was added before the last newsletter. Ignoring.")
+                    continue
             if item["Type"] == "Episode":
                 populate_series_item_from_episode(series_items, item)
     
@@ -204,7 +268,8 @@ def send_newsletter():
             movies=movie_items,
             series=series_items,
             total_tv=total_tv,
-            total_movie=total_movie
+            total_movie=total_movie,
+            newsletter_date=now
         )
 
         # Log results based on mode
@@ -56,4 +56,26 @@ def get_item_from_parent_by_id(parent_id, item_id):
     for item in response.json()["Items"]:
         if "Id" in item.keys():
             if item["Id"] == item_id:
-                return item
\ No newline at end of file
+                return item
+
+def get_items_from_parent_by_ids(parent_id, item_ids, batch_size=50):
+    """
+    Batched version of get_item_from_parent_by_id.
+    Retrieves all the given items from the parent folder using comma-separated Ids, in batches to keep the URL short.
+    Returns a dict item_id -> item, containing only the items found in the parent folder.
+    """
+    headers = {
+        "Authorization": f'MediaBrowser Token="{conf.jellyfin.api_token}"'
+    }
+    item_ids = list(item_ids)
+    found_items = {}
+    for i in range(0, len(item_ids), batch_size):
+        ids = ",".join(item_ids[i:i + batch_size])
+        response = requests.get(f'{conf.jellyfin.url}/Items?ParentId={parent_id}&fields=DateCreated,ProviderIds&Recursive=true&ids={ids}', headers=headers)
+        if response.status_code != 200:
+            logging.error(f"Error while getting the items from parent, status code: {response.status_code}.")
+            raise Exception(f"Error while getting the items from parent, status code: {response.status_code}. Answer: {response.text}.")
+        for item in response.json()["Items"]:
+            if "Id" in item.keys():
+                found_items[item["Id"]] = item
+    return found_items
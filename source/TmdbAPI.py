@@ -1,8 +1,44 @@
-import requests
+import requests_cache
+import datetime as dt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from source import configuration 
 import json
 from source.configuration import logging
+from source.rate_limiter import TokenBucket
 
+# TMDB answers are cached on disk, in the config folder so the cache is kept between runs and container restarts. Delete the file to reset it.
+TMDB_CACHE_FILE = "./config/tmdb_cache" # .sqlite is appended by requests-cache
+
+# Shared session, so TCP and TLS connections to TMDB are reused between requests (and between the lookup threads)
+_SESSION = requests_cache.CachedSession(
+    cache_name=TMDB_CACHE_FILE,
+    backend='sqlite',
+    expire_after=dt.timedelta(days=30),
+    urls_expire_after={'api.themoviedb.org/3/search': dt.timedelta(days=7)}, # Search results change more often than media details
+    allowable_codes=(200,),
+)
+
+# TMDB request ceiling (40 requests every 10 seconds), shared by all the lookup threads
+_RATE_LIMITER = TokenBucket(rate=40, per=10)
+
+
+class _RateLimitedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter waiting for the rate limiter before each request.
+    Answers from the requests cache never reach the adapter, so only the requests actually sent to TMDB are limited.
+    """
+
+    def send(self, request, **kwargs):
+        _RATE_LIMITER.consume()
+        return super().send(request, **kwargs)
+
+
+_SESSION.mount('https://', _RateLimitedAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+))
 
 
 def get_media_detail_from_title(title, type, year=None):
@@ -22,7 +58,7 @@ def get_media_detail_from_title(title, type, year=None):
         "Authorization": f"Bearer {configuration.conf.tmdb.api_key}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url, headers=headers)
     if response.status_code != 200:
         logging.error(f"Error while getting media detail from title, status code: {response.status_code}.")
         raise Exception(f"Error while getting the token, status code: {response.status_code}. Answer: {response.text}.")
@@ -58,7 +94,7 @@ def get_media_detail_from_id(id, type):
         "Authorization": f"Bearer {configuration.conf.tmdb.api_key}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url, headers=headers)
     if response.status_code != 200:
         logging.error(f"Error while getting media detail from id, status code: {response.status_code}.")
         raise Exception(f"Error while getting media detail from id, status code: {response.status_code}. Answer: {response.text}.")
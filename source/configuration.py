@@ -1,5 +1,7 @@
 import yaml
 import logging
+import hashlib
+import json
 
 
 
@@ -37,6 +39,9 @@ class Jellyfin:
         self.api_token = data["api_token"]
         self.watched_film_folders = data["watched_film_folders"]
         self.watched_tv_folders = data["watched_tv_folders"]
+        # Case-folded sets, used to match Jellyfin folder names
+        self.watched_film_folders_set = frozenset(str(folder).casefold() for folder in self.watched_film_folders or [])
+        self.watched_tv_folders_set = frozenset(str(folder).casefold() for folder in self.watched_tv_folders or [])
         self.observed_period_days = data["observed_period_days"]
         self.ignore_item_added_before_last_newsletter = data["ignore_item_added_before_last_newsletter"] if "ignore_item_added_before_last_newsletter" in data else False
 
@@ -77,6 +82,10 @@ class Email:
         self.smtp_password = data["smtp_password"]
         self.smtp_sender_email = data["smtp_sender_email"]
         self.smtp_tls_type = data.get("smtp_tls_type") or "STARTTLS" # Fallback to STARTTLS if not specified
+        self.smtp_rate_per_second = data.get("smtp_rate_per_second", 0) # Maximum number of emails sent per second, 0 means unlimited
+        self.batch_recipients = data.get("batch_recipients", False) # Send one email to all recipients, as blind copies
+        self.concurrency = data.get("concurrency", 1) # Number of SMTP connections used in parallel
+        self.max_emails_per_connection = data.get("max_emails_per_connection", 0) # Reconnect after this number of emails, 0 means never
 
 
 class DryRunConfig:
@@ -123,6 +132,9 @@ try:
         try:
             raw_conf = yaml.safe_load(config_yml)
             conf = Config(raw_conf)
+            # The configuration doesn't change at runtime, hash it once.
+            # blake2b of the loaded YAML is stable across runs, unlike the salted built-in hash().
+            conf_hash = hashlib.blake2b(json.dumps(raw_conf, sort_keys=True, default=str).encode('utf-8'), digest_size=8).hexdigest()
         
         except yaml.YAMLError as exc:
             raise Exception(exc)
@@ -78,6 +78,21 @@ def check_email_configuration():
     # SMTP TLS type
     assert isinstance(conf.email.smtp_tls_type, str), "[FATAL] Invalid email SMTP TLS type. The SMTP TLS type must be a string. Please check the configuration."
     assert conf.email.smtp_tls_type in ['STARTTLS', 'TLS'], "[FATAL] Invalid SMTP TLS type. The SMTP TLS type must be either 'STARTTLS' or 'TLS'. Please check the configuration."
+
+    # SMTP rate
+    assert isinstance(conf.email.smtp_rate_per_second, (int, float)) and not isinstance(conf.email.smtp_rate_per_second, bool), "[FATAL] Invalid email smtp_rate_per_second. The smtp_rate_per_second must be a number. Please check the configuration."
+    assert conf.email.smtp_rate_per_second >= 0, "[FATAL] Invalid email smtp_rate_per_second. The smtp_rate_per_second cannot be negative. Please check the configuration."
+
+    # Concurrency
+    assert isinstance(conf.email.concurrency, int) and not isinstance(conf.email.concurrency, bool), "[FATAL] Invalid email concurrency. The concurrency must be an integer. Please check the configuration."
+    assert conf.email.concurrency > 0, "[FATAL] Invalid email concurrency. The concurrency must be greater than 0. Please check the configuration."
+
+    # Max emails per connection
+    assert isinstance(conf.email.max_emails_per_connection, int) and not isinstance(conf.email.max_emails_per_connection, bool), "[FATAL] Invalid email max_emails_per_connection. The max_emails_per_connection must be an integer. Please check the configuration."
+    assert conf.email.max_emails_per_connection >= 0, "[FATAL] Invalid email max_emails_per_connection. The max_emails_per_connection cannot be negative. Please check the configuration."
+
+    # Batch recipients
+    assert isinstance(conf.email.batch_recipients, bool), "[FATAL] Invalid email batch_recipients. The batch_recipients flag must be a boolean. Please check the configuration."
     
 def check_recipients_configuration():
     # Recipients
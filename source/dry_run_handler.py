@@ -1,7 +1,20 @@
 import os
+import re
 import json
 import datetime
 from source import configuration
+from source.utils import write_file_atomically
+
+try:
+    import orjson
+except ImportError: # Optional, the standard json module is used if orjson is not installed
+    orjson = None
+
+# Docker environment detection, doesn't change during the process lifetime
+_IS_DOCKER = os.path.exists('/app')
+
+# Placeholders supported in dry_run.output_filename, any other character of the filename is kept as is
+_FILENAME_PLACEHOLDER = re.compile(r'\{(date|time|timestamp)\}')
 
 
 class DryRunHandler:
@@ -9,8 +22,12 @@ class DryRunHandler:
     Handles dry-run functionality for the newsletter
     """
     
+    # Output directories already created by this process, they are not checked again
+    _directories_ensured = set()
+    
     def __init__(self):
         self.config = configuration.conf.dry_run
+        self._resolved_output_dir = self._resolve_output_directory()
         self._ensure_output_directory()
     
     def _resolve_output_directory(self):
@@ -21,7 +38,7 @@ class DryRunHandler:
         output_dir = self.config.output_directory
         
         # Handle Docker vs local environment
-        if os.path.exists('/app'):
+        if _IS_DOCKER:
             # Docker environment - use absolute paths as configured
             if output_dir.startswith('/app'):
                 return output_dir
@@ -39,39 +56,43 @@ class DryRunHandler:
     def _ensure_output_directory(self):
         """Create output directory if it doesn't exist"""
         if self.config.enabled:
-            actual_path = self._resolve_output_directory()
+            actual_path = self._resolved_output_dir
+            if actual_path in DryRunHandler._directories_ensured:
+                return
             try:
                 os.makedirs(actual_path, exist_ok=True)
+                DryRunHandler._directories_ensured.add(actual_path)
                 # Log the actual path being used
                 configuration.logging.info(f"Dry-run directory: {os.path.abspath(actual_path)}")
             except Exception as e:
                 configuration.logging.error(f"Failed to create dry-run directory '{actual_path}': {e}")
                 raise
     
-    def _generate_filename(self, suffix=""):
-        """Generate filename with date/timestamp placeholders"""
+    def _filename_placeholders(self):
+        """Values of the date/timestamp placeholders, computed once so all the files of a dry-run share them"""
         now = datetime.datetime.now()
-        
-        filename = self.config.output_filename
-        
-        # Replace placeholders
-        filename = filename.replace('{date}', now.strftime('%Y-%m-%d'))
-        filename = filename.replace('{timestamp}', now.strftime('%Y%m%d_%H%M%S'))
-        filename = filename.replace('{time}', now.strftime('%H%M%S'))
+        return {
+            'date': now.strftime('%Y-%m-%d'),
+            'timestamp': now.strftime('%Y%m%d_%H%M%S'),
+            'time': now.strftime('%H%M%S'),
+        }
+    
+    def _format_filename(self, placeholders, suffix=""):
+        """Generate filename with date/timestamp placeholders"""
+        # Replace placeholders in a single pass, unknown placeholders and other braces are left untouched
+        filename = _FILENAME_PLACEHOLDER.sub(lambda match: placeholders[match.group(1)], self.config.output_filename)
         
         # Add suffix if provided
         if suffix:
             name, ext = os.path.splitext(filename)
             filename = f"{name}_{suffix}{ext}"
         
-        # Ensure we have the right directory
-        output_dir = self._resolve_output_directory()
-        return os.path.join(output_dir, filename)
+        return os.path.join(self._resolved_output_dir, filename)
     
-    def _add_metadata_to_html(self, html_content, metadata):
-        """Add metadata to HTML as comments"""
+    def _add_metadata_to_html(self, html_bytes, metadata):
+        """Add metadata to the UTF-8 encoded HTML as comments"""
         if not self.config.include_metadata:
-            return html_content
+            return html_bytes
         
         metadata_comment = f"""<!--
 Newsletter Generation Metadata:
@@ -83,9 +104,17 @@ TV Episodes: {metadata['stats']['tv_episodes_count']}
 Email Size: {metadata['stats']['total_email_size_kb']}KB
 -->"""
         
-        return metadata_comment + '\n' + html_content
+        metadata_comment = metadata_comment.encode('utf-8')
+        
+        # Insert the comment after the DOCTYPE: anything before it makes browsers render the page in quirks mode
+        doctype_start = html_bytes[:1024].lower().find(b'<!doctype')
+        if doctype_start != -1:
+            doctype_end = html_bytes.find(b'>', doctype_start)
+            if doctype_end != -1:
+                return b''.join((html_bytes[:doctype_end + 1], b'\n', metadata_comment, html_bytes[doctype_end + 1:]))
+        return metadata_comment + b'\n' + html_bytes
     
-    def save_dry_run_output(self, html_content, metadata, mode="dry-run"):
+    def save_dry_run_output(self, html_content, metadata, mode="dry-run", html_bytes=None):
         """
         Save HTML output and optional JSON metadata
         
@@ -93,6 +122,7 @@ Email Size: {metadata['stats']['total_email_size_kb']}KB
             html_content (str): The generated HTML email content
             metadata (dict): Email generation metadata
             mode (str): "dry-run" or "dry-run-smtp-only"
+            html_bytes (bytes): html_content already encoded in UTF-8, to avoid encoding it again
             
         Returns:
             tuple: (html_file_path, json_file_path or None)
@@ -102,21 +132,34 @@ Email Size: {metadata['stats']['total_email_size_kb']}KB
         
         try:
             # Generate filenames
-            html_file = self._generate_filename()
+            placeholders = self._filename_placeholders()
+            html_file = self._format_filename(placeholders)
             
+            if html_bytes is None:
+                html_bytes = html_content.encode('utf-8')
+
             # Add metadata to HTML if enabled
-            final_html = self._add_metadata_to_html(html_content, metadata)
+            final_html = self._add_metadata_to_html(html_bytes, metadata)
             
             # Save HTML file
-            with open(html_file, 'w', encoding='utf-8') as f:
-                f.write(final_html)
+            try:
+                write_file_atomically(html_file, final_html)
+            except FileNotFoundError:
+                # The output directory has been removed since it was created, e.g. between two scheduled runs
+                DryRunHandler._directories_ensured.discard(self._resolved_output_dir)
+                self._ensure_output_directory()
+                write_file_atomically(html_file, final_html)
             
             # Save JSON metadata if enabled
             json_file = None
             if self.config.save_email_data:
-                json_file = self._generate_filename("data").replace('.html', '.json')
-                with open(json_file, 'w', encoding='utf-8') as f:
-                    json.dump(metadata, f, indent=2, ensure_ascii=False, default=str)
+                json_file = self._format_filename(placeholders, "data").replace('.html', '.json')
+                # Serialized in one go and written with a single write call
+                if orjson is not None:
+                    json_bytes = orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str)
+                else:
+                    json_bytes = json.dumps(metadata, indent=2, ensure_ascii=False, default=str).encode('utf-8')
+                write_file_atomically(json_file, json_bytes)
             
             # Log actual file locations
             configuration.logging.info(f"Dry-run output saved: {os.path.abspath(html_file)}")
@@ -129,29 +172,36 @@ Email Size: {metadata['stats']['total_email_size_kb']}KB
             configuration.logging.error(f"Failed to save dry-run files: {e}")
             raise
     
-    def get_metadata(self, movies, series, total_tv, total_movie, mode="dry-run", smtp_tested=False):
-        """Generate metadata for the email"""
-        now = datetime.datetime.now()
-        
+    def _build_item_lists(self, movies, series):
+        """Build the movies and series lists saved in the JSON metadata"""
         # Prepare movies data for JSON
         movies_list = []
-        for movie_id, movie_data in movies.items():
+        for movie_data in movies.values():
             movies_list.append({
                 "name": movie_data.get('name', 'Unknown'),
-                "added_date": movie_data.get('created_on', '').split('T')[0],
+                "added_date": (movie_data.get('created_on') or '')[:10], # ISO-8601, the date is the fixed-width YYYY-MM-DD prefix
                 "tmdb_id": movie_data.get('tmdb_id', '')
             })
         
         # Prepare series data for JSON
         series_list = []
-        for serie_id, serie_data in series.items():
+        for serie_data in series.values():
             series_list.append({
                 "series_name": serie_data.get('series_name', 'Unknown'),
                 "seasons": serie_data.get('seasons', []),
                 "episodes": serie_data.get('episodes', []),
-                "added_date": serie_data.get('created_on', '').split('T')[0]
+                "added_date": (serie_data.get('created_on') or '')[:10]
             })
         
+        return movies_list, series_list
+    
+    def get_metadata(self, movies, series, total_tv, total_movie, mode="dry-run", smtp_tested=False):
+        """Generate metadata for the email"""
+        now = datetime.datetime.now()
+        
+        # Items lists are only written in the JSON metadata file, the HTML comment only uses the stats
+        movies_list, series_list = self._build_item_lists(movies, series) if self.config.save_email_data else ([], [])
+        
         metadata = {
             "generation_timestamp": now.isoformat(),
             "mode": mode,
@@ -166,7 +216,7 @@ Email Size: {metadata['stats']['total_email_size_kb']}KB
             "tv_shows": series_list,
             "recipients": configuration.conf.recipients if mode == "dry-run-smtp-only" else ["dry-run-mode"],
             "template_language": configuration.conf.email_template.language,
-            "configuration_hash": str(hash(str(configuration.conf.__dict__)))
+            "configuration_hash": configuration.conf_hash
         }
         
         return metadata
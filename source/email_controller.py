@@ -2,15 +2,20 @@ from source import configuration
 from source import context
 from source.dry_run_handler import DryRunHandler
 import smtplib
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.generator import BytesGenerator
+from email.policy import compat32
+from io import BytesIO
 from source.configuration import logging
-from time import sleep
+from source.rate_limiter import TokenBucket
 from source.utils import save_last_newsletter_date
 import datetime as dt
 
 
-def send_newsletter(html_content, movies=None, series=None, total_tv=0, total_movie=0):
+def send_newsletter(html_content, movies=None, series=None, total_tv=0, total_movie=0, newsletter_date=None):
     """
     Send newsletter or generate dry-run output based on configuration
     
@@ -20,6 +25,7 @@ def send_newsletter(html_content, movies=None, series=None, total_tv=0, total_mo
         series (dict): Series data for metadata  
         total_tv (int): Total TV episodes count
         total_movie (int): Total movie count
+        newsletter_date (datetime): Date saved as the last newsletter date, defaults to now
     
     Returns:
         dict: Result information
@@ -28,83 +34,90 @@ def send_newsletter(html_content, movies=None, series=None, total_tv=0, total_mo
     if configuration.conf.dry_run.enabled:
         return _handle_dry_run_mode(html_content, movies or {}, series or {}, total_tv, total_movie)
     else:
-        return _send_normal_email(html_content)
+        return _send_normal_email(html_content, newsletter_date)
+
+
+# Created on first use, then reused by the next scheduled runs
+_dry_run_handler = None
+
+
+def _get_dry_run_handler():
+    """Return the dry-run handler, created once per process"""
+    global _dry_run_handler
+    if _dry_run_handler is None:
+        _dry_run_handler = DryRunHandler()
+    return _dry_run_handler
 
 
 def _handle_dry_run_mode(html_content, movies, series, total_tv, total_movie):
     """Handle dry-run mode"""
-    dry_run_handler = DryRunHandler()
+    dry_run_handler = _get_dry_run_handler()
+    smtp_tested = False
     
     if configuration.conf.dry_run.test_smtp_connection:
         # Dry-run mode: test SMTP + save output
         mode = "dry-run-smtp-only"
-        smtp_tested = False
-        
         try:
             _test_smtp_connection()
             smtp_tested = True
             logging.info("SMTP connection test: SUCCESS")
         except Exception as e:
             logging.error(f"SMTP connection test: FAILED - {e}")
-            
-        # Generate metadata with SMTP test result
-        metadata = dry_run_handler.get_metadata(movies, series, total_tv, total_movie, mode, smtp_tested)
-        
-        # Calculate email size
-        metadata['stats']['total_email_size_kb'] = round(len(html_content.encode('utf-8')) / 1024, 1)
-        
-        # Save dry-run files
-        html_file, json_file = dry_run_handler.save_dry_run_output(html_content, metadata, mode)
-        
-        # Log dry-run results
-        logging.info("DRY-RUN MODE RESULTS:")
-        logging.info(f"Would send to: {', '.join(configuration.conf.recipients)}")
-        logging.info(f"Email size: {metadata['stats']['total_email_size_kb']}KB")
-        logging.info(f"Dry-run output saved: {html_file}")
-        if json_file:
-            logging.info(f"Metadata saved: {json_file}")
-        
-        return {
-            "mode": mode,
-            "smtp_tested": smtp_tested,
-            "html_file": html_file,
-            "json_file": json_file,
-            "recipients": configuration.conf.recipients,
-            "email_size_kb": metadata['stats']['total_email_size_kb']
-        }
-        
     else:
         # Dry-run only mode: skip SMTP entirely
         mode = "dry-run"
         
-        # Generate metadata
-        metadata = dry_run_handler.get_metadata(movies, series, total_tv, total_movie, mode, False)
-        
-        # Calculate email size
-        metadata['stats']['total_email_size_kb'] = round(len(html_content.encode('utf-8')) / 1024, 1)
-        
-        # Save dry-run files
-        html_file, json_file = dry_run_handler.save_dry_run_output(html_content, metadata, mode)
-        
-        # Log dry-run results
-        logging.info("DRY-RUN MODE RESULTS:")
-        logging.info(f"Email size: {metadata['stats']['total_email_size_kb']}KB")
-        logging.info(f"Dry-run output saved: {html_file}")
-        if json_file:
-            logging.info(f"Metadata saved: {json_file}")
+    # Generate metadata, with the SMTP test result
+    metadata = dry_run_handler.get_metadata(movies, series, total_tv, total_movie, mode, smtp_tested)
+    
+    # Calculate email size. Encoded once, the same bytes are saved to the dry-run file
+    html_bytes = html_content.encode('utf-8')
+    metadata['stats']['total_email_size_kb'] = round(len(html_bytes) / 1024, 1)
+    
+    # Save dry-run files
+    html_file, json_file = dry_run_handler.save_dry_run_output(html_content, metadata, mode, html_bytes=html_bytes)
+    
+    # Log dry-run results
+    logging.info("DRY-RUN MODE RESULTS:")
+    if mode == "dry-run-smtp-only":
+        logging.info(f"Would send to: {', '.join(configuration.conf.recipients)}")
+    logging.info(f"Email size: {metadata['stats']['total_email_size_kb']}KB")
+    logging.info(f"Dry-run output saved: {html_file}")
+    if json_file:
+        logging.info(f"Metadata saved: {json_file}")
+    if mode == "dry-run":
         logging.info("SMTP testing skipped (dry-run only mode)")
-        
-        return {
-            "mode": mode,
-            "smtp_tested": False,
-            "html_file": html_file,
-            "json_file": json_file,
-            "email_size_kb": metadata['stats']['total_email_size_kb']
-        }
+    
+    result = {
+        "mode": mode,
+        "smtp_tested": smtp_tested,
+        "html_file": html_file,
+        "json_file": json_file,
+        "email_size_kb": metadata['stats']['total_email_size_kb']
+    }
+    if mode == "dry-run-smtp-only":
+        result["recipients"] = configuration.conf.recipients
+    return result
 
 
-def _test_smtp_connection():
-    """Test SMTP connection without sending email"""
+# Policy used to serialize emails, SMTP requires CRLF line endings
+_SMTP_POLICY = compat32.clone(linesep="\r\n")
+
+
+def _flatten_message(msg):
+    """Serialize the email to the bytes sent over SMTP"""
+    buffer = BytesIO()
+    BytesGenerator(buffer, mangle_from_=False, policy=_SMTP_POLICY).flatten(msg)
+    return buffer.getvalue()
+
+
+def _to_header(recipient):
+    """Serialized "To" header line, prepended to the serialized email for each recipient"""
+    return _SMTP_POLICY.fold("To", recipient).encode('ascii')
+
+
+def _connect_smtp():
+    """Open a SMTP connection with the configured TLS type and log in"""
     tls_type = configuration.conf.email.smtp_tls_type.upper()
     
     if tls_type == "TLS":
@@ -115,8 +128,165 @@ def _test_smtp_connection():
     else:
         raise Exception(f"Invalid SMTP TLS type: {tls_type}")
     
-    # Test login
     smtp_server.login(configuration.conf.email.smtp_user, configuration.conf.email.smtp_password)
+    return smtp_server
+
+
+def _pipelined_sendmail(smtp_server, sender, recipients, message):
+    """
+    Same as smtp_server.sendmail, but when the server supports PIPELINING (RFC 2920) the MAIL FROM and RCPT TO commands
+    are sent together and their answers read afterwards, instead of waiting for the server after each command.
+    """
+    smtp_server.ehlo_or_helo_if_needed()
+    if not smtp_server.has_extn('pipelining'):
+        return smtp_server.sendmail(sender, recipients, message)
+
+    smtp_server.putcmd("mail", f"FROM:{smtplib.quoteaddr(sender)}")
+    for recipient in recipients:
+        smtp_server.putcmd("rcpt", f"TO:{smtplib.quoteaddr(recipient)}")
+    # All the answers are read before checking them, so the connection stays in sync with the server
+    mail_code, mail_response = smtp_server.getreply()
+    rcpt_replies = [smtp_server.getreply() for _ in recipients]
+
+    if mail_code != 250:
+        if mail_code == 421:
+            smtp_server.close()
+        else:
+            smtp_server.rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_response, sender)
+    refused = {recipient: reply for recipient, reply in zip(recipients, rcpt_replies) if reply[0] not in (250, 251)}
+    if any(code == 421 for code, _ in refused.values()):
+        smtp_server.close()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        smtp_server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = smtp_server.data(message)
+    if code != 250:
+        if code == 421:
+            smtp_server.close()
+        else:
+            smtp_server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _is_connection_dropped(error):
+    """True if the SMTP error means the server closed the connection, a 421 answer to any command included"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    # A 421 answer to RCPT TO is reported among the refused recipients
+    return any(code == 421 for code, _ in error.recipients.values())
+
+
+def _sendmail(smtp_server, sender, recipients, message):
+    """
+    Send the message, reconnecting once if the server dropped the connection (disconnection or 421 answer).
+    Returns the SMTP connection to use for the next emails, and the recipients refused by the server (see smtplib sendmail).
+    """
+    try:
+        refused = _pipelined_sendmail(smtp_server, sender, recipients, message)
+        return smtp_server, refused
+    except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+        if not _is_connection_dropped(e):
+            raise
+        logging.warning(f"SMTP connection lost ({e}). Reconnecting and retrying once.")
+        smtp_server = _renew_connection(smtp_server)
+        refused = _pipelined_sendmail(smtp_server, sender, recipients, message)
+        return smtp_server, refused
+
+
+def _renew_connection(smtp_server):
+    """Close the SMTP connection, even if the server already dropped it, and open a new one"""
+    try:
+        smtp_server.quit()
+    except Exception:
+        smtp_server.close()
+    return _connect_smtp()
+
+
+def _send_to_recipient(smtp_server, sent_on_connection, sender, recipient, base_message, rate_limiter):
+    """
+    Send the email to one recipient, through a new connection if the current one reached email.max_emails_per_connection.
+    Returns the connection to use for the next emails, and the number of emails sent on it.
+    """
+    max_emails = configuration.conf.email.max_emails_per_connection
+    if max_emails > 0 and sent_on_connection >= max_emails:
+        logging.debug(f"{sent_on_connection} emails sent on this SMTP connection. Opening a new one.")
+        smtp_server = _renew_connection(smtp_server)
+        sent_on_connection = 0
+    if rate_limiter is not None:
+        rate_limiter.consume()
+    # Nothing is refused here: with a single recipient, a refusal raises SMTPRecipientsRefused
+    smtp_server, _ = _sendmail(smtp_server, sender, [recipient], _to_header(recipient) + base_message)
+    return smtp_server, sent_on_connection + 1
+
+
+def _send_concurrently(smtp_server, sender, recipients, base_message, rate_limiter, concurrency):
+    """
+    Send the email to each recipient using `concurrency` SMTP connections in parallel.
+    smtp_server is used as the first connection. All connections are closed at the end.
+    Returns the number of emails sent.
+    """
+    # Pool of (connection, number of emails sent on it)
+    connections = queue.Queue()
+    connections.put((smtp_server, 0))
+
+    def send_one(recipient):
+        # Each worker takes a connection from the pool for one email and gives it back, possibly reconnected
+        connection, sent_on_connection = connections.get()
+        try:
+            connection, sent_on_connection = _send_to_recipient(connection, sent_on_connection, sender, recipient, base_message, rate_limiter)
+        finally:
+            connections.put((connection, sent_on_connection))
+
+    sent_count = 0
+    try:
+        for _ in range(concurrency - 1):
+            try:
+                connections.put((_connect_smtp(), 0))
+            except Exception as e:
+                # e.g. the provider limits the number of simultaneous logins, the connections already opened are enough
+                logging.warning(f"Could not open another SMTP connection, sending with {connections.qsize()} connection(s). Got error: {e}")
+                break
+        with ThreadPoolExecutor(max_workers=connections.qsize()) as executor:
+            futures = {executor.submit(send_one, recipient): recipient for recipient in recipients}
+            error = None
+            # Logged as soon as each email is sent, not in the recipients order
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Error while sending the email to {futures[future]}: {e}")
+                    if error is None:
+                        # Stop at the first failure like the sequential loop. The emails already being sent are still logged
+                        error = e
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                logging.info(f"Email sent to {futures[future]}")
+                sent_count += 1
+        if error is not None:
+            logging.error(f"Sending stopped after an error, {sent_count} email(s) sent.")
+            raise error
+    finally:
+        while not connections.empty():
+            try:
+                connections.get_nowait()[0].quit()
+            except Exception:
+                pass
+    return sent_count
+
+
+def _test_smtp_connection():
+    """Test SMTP connection without sending email"""
+    # Test connection and login
+    smtp_server = _connect_smtp()
     
     # Test recipient validation (basic check)
     for recipient in configuration.conf.recipients:
@@ -128,38 +298,48 @@ def _test_smtp_connection():
     logging.info(f"Recipients validated: {len(configuration.conf.recipients)} addresses")
 
 
-def _send_normal_email(html_content):
+def _send_normal_email(html_content, newsletter_date=None):
     """Send email normally (original functionality)"""
     try:      
-        tls_type = configuration.conf.email.smtp_tls_type.upper()
-        if tls_type == "TLS":
-            smtp_server = smtplib.SMTP_SSL(configuration.conf.email.smtp_server, configuration.conf.email.smtp_port)
-        elif tls_type == "STARTTLS":
-            smtp_server = smtplib.SMTP(configuration.conf.email.smtp_server, configuration.conf.email.smtp_port)
-            smtp_server.starttls()
-        else:
-            raise Exception(f"Invalid SMTP TLS type: {tls_type}")
-        smtp_server.login(configuration.conf.email.smtp_user, configuration.conf.email.smtp_password)
+        smtp_server = _connect_smtp()
     except Exception as e:
         raise Exception(f"Error while connecting to the SMTP server. Got error: {e}")
     
+    # The email is the same for every recipient: it is built and serialized once, only the "To" header is added per recipient
+    sender = configuration.conf.email.smtp_sender_email
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = configuration.conf.email_template.subject.format_map(context.placeholders)
+    msg['From'] = sender
+    msg.attach(MIMEText(html_content, 'html'))
+    # Kept as bytes, so sendmail doesn't re-encode and fix the line endings of the whole email for every recipient
+    base_message = _flatten_message(msg)
+
     sent_count = 0
-    for recipient in configuration.conf.recipients:
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = configuration.conf.email_template.subject.format_map(context.placeholders)
-        msg['From'] = configuration.conf.email.smtp_sender_email
-        part = MIMEText(html_content, 'html')
-    
-        msg.attach(part)
-        msg['To'] = recipient
-        smtp_server.sendmail(configuration.conf.email.smtp_sender_email, recipient, msg.as_string())
-        logging.info(f"Email sent to {recipient}")
-        sent_count += 1
-        sleep(2)
-    smtp_server.quit()
+    if configuration.conf.email.batch_recipients:
+        # Recipients are only given to the SMTP server, as blind copies
+        smtp_server, refused = _sendmail(smtp_server, sender, configuration.conf.recipients, _to_header(sender) + base_message)
+        for recipient, (code, response) in refused.items():
+            logging.error(f"Recipient {recipient} refused by the SMTP server: {code} {response}")
+        sent_count = len(configuration.conf.recipients) - len(refused)
+        logging.info(f"Email sent to {sent_count} recipients in a single batch")
+    else:
+        # Sends in bursts and only waits when the provider rate is reached
+        rate_limiter = TokenBucket(rate=configuration.conf.email.smtp_rate_per_second) if configuration.conf.email.smtp_rate_per_second > 0 else None
+        concurrency = min(configuration.conf.email.concurrency, len(configuration.conf.recipients))
+        if concurrency > 1:
+            sent_count = _send_concurrently(smtp_server, sender, configuration.conf.recipients, base_message, rate_limiter, concurrency)
+            smtp_server = None # Closed with the other pooled connections
+        else:
+            sent_on_connection = 0
+            for recipient in configuration.conf.recipients:
+                smtp_server, sent_on_connection = _send_to_recipient(smtp_server, sent_on_connection, sender, recipient, base_message, rate_limiter)
+                logging.info(f"Email sent to {recipient}")
+                sent_count += 1
+    if smtp_server is not None:
+        smtp_server.quit()
 
     if not configuration.conf.dry_run.enabled:
-        save_last_newsletter_date(dt.datetime.now())
+        save_last_newsletter_date(newsletter_date or dt.datetime.now())
     else:
         logging.info("Dry run enabled - not saving last newsletter date")
 
@@ -0,0 +1,32 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+    Allows bursts of up to `rate` actions, then an average of `rate` actions every `per` seconds.
+    Thread-safe, so it can be shared between workers.
+    """
+
+    def __init__(self, rate, per=1.0):
+        self.capacity = max(rate, 1) # At least one token, otherwise a rate below 1 would never allow any action
+        self.fill_rate = rate / per
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until enough tokens are available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.fill_rate)
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.fill_rate
+            time.sleep(wait)
@@ -0,0 +1,45 @@
+"""
+In-process memoization of TMDB lookups.
+The same media can be requested several times during a newsletter run, these wrappers make sure TMDB is only called once per media.
+The caches are cleared at the start of each run (see clear), so a long running scheduler still gets fresh TMDB data.
+"""
+
+from functools import lru_cache
+from source import TmdbAPI
+
+
+@lru_cache(maxsize=4096)
+def _detail_by_id(id, type):
+    return TmdbAPI.get_media_detail_from_id(id=id, type=type)
+
+
+@lru_cache(maxsize=4096)
+def _detail_by_title(title, type, year):
+    return TmdbAPI.get_media_detail_from_title(title=title, type=type, year=year)
+
+
+def cached_detail_by_id(id, type):
+    """
+    Cached version of TmdbAPI.get_media_detail_from_id.
+    """
+    return _detail_by_id(str(id).strip(), type)
+
+
+def cached_detail_by_title(title, type, year=None):
+    """
+    Cached version of TmdbAPI.get_media_detail_from_title.
+    The title is normalized so case or whitespace variants of the same title share the same cache entry.
+    """
+    try:
+        year = int(year) if year else None
+    except (TypeError, ValueError):
+        year = None
+    return _detail_by_title(title.strip().lower(), type, year)
+
+
+def clear():
+    """
+    Forget the lookups of the previous newsletter run.
+    """
+    _detail_by_id.cache_clear()
+    _detail_by_title.cache_clear()
@@ -1,4 +1,7 @@
 import datetime as dt
+import os
+from functools import lru_cache
+from pathlib import Path
 from source.configuration import logging
 
 LAST_NEWSLETTER_FILE = "./config/LAST_NEWSLETTER.txt"
@@ -10,13 +13,12 @@ def summarize_ranges(nums):
     """
     if not nums:
         return []
-    # convert all elements to integers
+    # convert all elements to integers, and drop duplicates (e.g. several versions of the same episode)
     try:
-        nums = list(map(int, nums))
+        nums = sorted(set(map(int, nums)))
     except Exception as e:
         logging.error(f"Error while checking episodes for a show. Episodes list will not be displayed in the final email due to this error : {e}")
         return None
-    nums = sorted(nums)
     result = []
     start = nums[0]
     end = nums[0]
@@ -43,17 +45,29 @@ def get_last_newsletter_date():
     """
     Returns the date of the last newsletter.
     If the file does not exist, it returns None.
+    The file is only read again when it has been modified, so deleting it still resets the date of a running scheduler.
     """
     try:
-        with open(LAST_NEWSLETTER_FILE, "r") as f:
-            date_str = f.readline().strip()
-        try:
-            return dt.datetime.fromisoformat(date_str)
-        except ValueError:
-            logging.error(f"Error while parsing the date from LAST_NEWSLETTER.txt. Expected ISO format, got: {date_str}. It is highly recommended to delete this file and let the program create a new one.")
-            return None
+        modification_time = os.stat(LAST_NEWSLETTER_FILE).st_mtime_ns
     except FileNotFoundError:
         return None
+    return _read_last_newsletter_date(modification_time)
+
+
+@lru_cache(maxsize=1)
+def _read_last_newsletter_date(modification_time):
+    """
+    Reads and parses LAST_NEWSLETTER.txt. Cached by modification time of the file, see get_last_newsletter_date.
+    """
+    try:
+        date_str = Path(LAST_NEWSLETTER_FILE).read_text().partition("\n")[0].strip()
+    except FileNotFoundError:
+        return None
+    try:
+        return dt.datetime.fromisoformat(date_str)
+    except ValueError:
+        logging.error(f"Error while parsing the date from LAST_NEWSLETTER.txt. Expected ISO format, got: {date_str}. It is highly recommended to delete this file and let the program create a new one.")
+        return None
 
 def save_last_newsletter_date(date):
     """
@@ -62,5 +76,16 @@ def save_last_newsletter_date(date):
     """
     text = date.isoformat() + "\n\n/!\\ WARNING /!\\\n\nTHIS FILE IS AUTOMATICALLY GENERATED BY JELLYFIN NEWSLETTER. MANUALLY EDITING THIS FILE COULD CAUSE BUG OR CRASH.\nIF YOU WANT TO RESET THE LAST NEWSLETTER DATE, DELETE THIS FILE AND LET THE PROGRAM CREATE A NEW ONE."
 
-    with open(LAST_NEWSLETTER_FILE, "w") as f:
-        f.write(text)
\ No newline at end of file
+    write_file_atomically(LAST_NEWSLETTER_FILE, text.encode("utf-8"))
+    _read_last_newsletter_date.cache_clear()
+
+
+def write_file_atomically(path, data):
+    """
+    Writes the bytes to the file at path.
+    The data is written to a temporary file first, then moved in place, so a crash while writing never leaves a truncated file behind.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
\ No newline at end of file